@@ -1,20 +1,25 @@
 import os
+import sys
 import asyncio
 import logging
 import re
-from datetime import datetime, timedelta
-from io import BytesIO, StringIO
-from typing import Dict, List, Set, Tuple, Optional
+from datetime import datetime
+from io import BytesIO, TextIOWrapper
+from typing import Awaitable, Callable, Dict, Iterable, List, Tuple, Optional
 import random
 import time
-from collections import defaultdict
+from collections import OrderedDict
+from enum import IntEnum
+from functools import lru_cache
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
     filters, ContextTypes, CallbackQueryHandler
 )
 from telegram.error import TelegramError
+from aiolimiter import AsyncLimiter
+import orjson
 
 # Configure logging
 logging.basicConfig(
@@ -28,7 +33,28 @@ logger = logging.getLogger(__name__)
 # ============================================================================
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")  # Set in Render environment variables
 PORT = int(os.environ.get("PORT", 8443))
+# Update delivery: "webhook" or "polling" (webhook by default on Render)
+BOT_MODE = os.environ.get("BOT_MODE", "webhook" if "RENDER" in os.environ else "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", os.environ.get("RENDER_EXTERNAL_URL", ""))  # Public base URL
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", TOKEN or "")
 TIMEZONE_OFFSET = "+1"  # UTC+1
+CHECK_CONCURRENCY = int(os.environ.get("CHECK_CONCURRENCY", 50))  # Checks in flight at once
+WHATSAPP_RATE_LIMIT = int(os.environ.get("WHATSAPP_RATE_LIMIT", 0))  # Calls per minute, 0 = unlimited
+CHECK_CACHE_TTL = int(os.environ.get("CHECK_CACHE_TTL", 300))  # Seconds a check result is reused, 0 = off
+CHECK_CACHE_SIZE = 10000  # Max cached check results
+REDIS_URL = os.environ.get("REDIS_URL")  # Optional: share user settings across restarts/workers
+SESSION_TTL = 24 * 3600  # Seconds stored settings live in Redis
+ADMIN_IDS = {int(i) for i in os.environ.get("ADMIN_IDS", "").split(",") if i.strip()}  # Telegram user IDs
+PROGRESS_EDIT_INTERVAL = 2.0  # Min seconds between progress message edits
+# Check backends: simulated by default; set SIMULATE=false and the API URLs for real checks
+SIMULATE = os.environ.get("SIMULATE", "true").lower() != "false"
+WHATSAPP_API_URL = os.environ.get("WHATSAPP_API_URL", "")
+SMS_API_URL = os.environ.get("SMS_API_URL", "")
+API_TIMEOUT = 5  # Seconds per API request
+API_CONNECTIONS_PER_HOST = int(os.environ.get("API_CONNECTIONS_PER_HOST", 10))
+API_MAX_ATTEMPTS = 5  # Tries per request when the API answers 429/5xx
+API_MAX_RETRY_DELAY = 30  # Give up instead of honouring a longer Retry-After
 
 # Valid country codes (extend as needed)
 VALID_COUNTRY_CODES = {
@@ -54,17 +80,29 @@ VALID_COUNTRY_CODES = {
     '994', '995', '996', '998'
 }
 
+# Country codes bucketed by length so a prefix check is at most 3 set lookups
+_CC_BY_LEN = {
+    length: {cc for cc in VALID_COUNTRY_CODES if len(cc) == length}
+    for length in (3, 2, 1)
+}
+
 # ============================================================================
 # USER DATA MANAGEMENT
 # ============================================================================
+class FilterType(IntEnum):
+    """Which check outcome an operation keeps"""
+    ALL = 0
+    ON = 1
+    OFF = 2
+
 class UserData:
     def __init__(self):
         self.operations = {
             'whatsapp': True,      # Check WhatsApp
             'sms': True,           # Check SMS receive
             'combo_mode': False,   # Combo AND mode
-            'whatsapp_type': 'all',  # 'all', 'on', 'off'
-            'sms_type': 'all'       # 'all', 'on', 'off'
+            'whatsapp_type': FilterType.ALL,
+            'sms_type': FilterType.ALL
         }
         self.last_activity = datetime.now()
         self.processing = False
@@ -73,17 +111,17 @@ class UserData:
         """Get human-readable operations status"""
         ops = []
         if self.operations['whatsapp']:
-            if self.operations['whatsapp_type'] == 'on':
+            if self.operations['whatsapp_type'] == FilterType.ON:
                 ops.append("✅ On WhatsApp")
-            elif self.operations['whatsapp_type'] == 'off':
+            elif self.operations['whatsapp_type'] == FilterType.OFF:
                 ops.append("❌ Not on WhatsApp")
             else:
                 ops.append("📱 WhatsApp Status")
         
         if self.operations['sms']:
-            if self.operations['sms_type'] == 'on':
+            if self.operations['sms_type'] == FilterType.ON:
                 ops.append("📨 Can receive SMS")
-            elif self.operations['sms_type'] == 'off':
+            elif self.operations['sms_type'] == FilterType.OFF:
                 ops.append("⏳ SMS Try again later")
             else:
                 ops.append("📨 SMS Status")
@@ -92,28 +130,83 @@ class UserData:
             ops[-1] = f"🔀 COMBO: {' AND '.join(ops)}"
         
         return ops
+    
+    def snapshot(self) -> 'UserData':
+        """Copy of the operations, unaffected by later settings changes"""
+        job_settings = UserData()
+        job_settings.operations = dict(self.operations)
+        return job_settings
 
-# Store user data in memory (for production, use Redis/Database)
+# Store user data in memory; operations are mirrored to Redis when REDIS_URL is set
 user_sessions = {}
+if REDIS_URL:
+    # Imported only when configured; redis-py is heavy for a cold start
+    import redis.asyncio as redis
+    redis_client = redis.from_url(REDIS_URL)
+else:
+    redis_client = None
+
+async def get_user_data(user_id: int) -> UserData:
+    """
+    Get or create user data
+    With REDIS_URL set this costs one Redis round-trip per call, and the
+    stored operations replace the in-memory ones; if Redis is unreachable
+    the in-memory settings are used
+    """
+    user_data = user_sessions.get(user_id)
+    if user_data is None:
+        user_data = user_sessions[user_id] = UserData()
+    
+    if redis_client:
+        # Settings may have been changed by another worker or before a restart
+        try:
+            stored = await redis_client.get(f"user:{user_id}")
+        except redis.RedisError as e:
+            logger.warning(f"Redis read failed for user {user_id}, using in-memory settings: {e!r}")
+        else:
+            if stored:
+                user_data.operations = orjson.loads(stored)
+    
+    return user_data
 
-def get_user_data(user_id: int) -> UserData:
-    """Get or create user data"""
-    if user_id not in user_sessions:
-        user_sessions[user_id] = UserData()
-    return user_sessions[user_id]
+async def save_user_data(user_id: int, user_data: UserData):
+    """Persist user operations to Redis (no-op without REDIS_URL)"""
+    if redis_client:
+        try:
+            await redis_client.set(f"user:{user_id}", orjson.dumps(user_data.operations), ex=SESSION_TTL)
+        except redis.RedisError as e:
+            logger.warning(f"Redis write failed for user {user_id}, settings kept in memory only: {e!r}")
 
 # ============================================================================
 # NUMBER PROCESSING & VALIDATION
 # ============================================================================
+# Characters stripped from a number before validation
+_NON_DIGIT_RE = re.compile(r'[\s\-()]')
+# Delimiters between numbers in pasted text: line breaks, comma, semicolon, tab, space
+_SPLIT_RE = re.compile(r'[,\s;]+')
+# A CSV cell: any run of text between commas and line breaks
+_CSV_CELL_RE = re.compile(r'[^,\n]+')
+# Longest raw token worth normalizing; a valid number is at most 15 digits
+# even with formatting, and longer junk must not be kept as a cache key
+_MAX_TOKEN_LEN = 64
+
 def normalize_phone_number(number: str) -> Optional[str]:
     """
     Normalize phone number to E.164 format without +
     """
+    if len(number) > _MAX_TOKEN_LEN:
+        return None
+    
+    return _normalize_phone_number(number)
+
+@lru_cache(maxsize=131072)
+def _normalize_phone_number(number: str) -> Optional[str]:
+    """Cached body of normalize_phone_number"""
     # Remove all non-digit characters except leading +
     number = number.strip()
     
     # Remove spaces, dashes, parentheses
-    number = re.sub(r'[\s\-()]', '', number)
+    number = _NON_DIGIT_RE.sub('', number)
     
     # Handle + prefix
     if number.startswith('+'):
@@ -127,32 +220,27 @@ def normalize_phone_number(number: str) -> Optional[str]:
         return None
     
     # Extract country code
-    for cc in VALID_COUNTRY_CODES:
-        if number.startswith(cc):
+    for length, codes in _CC_BY_LEN.items():
+        if number[:length] in codes:
             # Ensure there's a subscriber number after country code
-            if len(number) > len(cc):
+            if len(number) > length:
                 return number
     
     # If no country code matches, assume it's already a national number
     # You might want to add a default country code here
     return number if len(number) >= 10 else None
 
+def normalize_phone_numbers(candidates: Iterable[str]) -> List[str]:
+    """
+    Normalize a batch of raw tokens, dropping invalid ones and duplicates
+    (input order is kept)
+    """
+    return list(dict.fromkeys(filter(None, map(normalize_phone_number, candidates))))
+
 def extract_numbers_from_text(text: str) -> List[str]:
     """Extract and normalize phone numbers from text"""
-    numbers = []
-    
-    # Split by lines and common delimiters
-    lines = text.split('\n')
-    for line in lines:
-        # Split by comma, semicolon, tab, or space
-        parts = re.split(r'[,\s;]+', line.strip())
-        for part in parts:
-            if part:
-                normalized = normalize_phone_number(part)
-                if normalized:
-                    numbers.append(normalized)
-    
-    return list(set(numbers))  # Remove duplicates
+    # Split by lines and common delimiters in one pass
+    return normalize_phone_numbers(_SPLIT_RE.split(text))
 
 def extract_numbers_from_file(file_content: bytes, filename: str) -> List[str]:
     """Extract numbers from uploaded file"""
@@ -166,30 +254,109 @@ def extract_numbers_from_file(file_content: bytes, filename: str) -> List[str]:
         elif filename.endswith('.csv'):
             text = file_content.decode('utf-8', errors='ignore')
             # Simple CSV parsing - look for numbers in all cells
-            lines = text.split('\n')
-            for line in lines:
-                cells = line.split(',')
-                for cell in cells:
-                    normalized = normalize_phone_number(cell.strip())
-                    if normalized:
-                        numbers.append(normalized)
+            numbers = normalize_phone_numbers(_CSV_CELL_RE.findall(text))
     
     except Exception as e:
         logger.error(f"Error parsing file: {e}")
     
-    return list(set(numbers))
+    return numbers
 
 # ============================================================================
-# SIMULATION FUNCTIONS (Replace with actual API calls)
+# CHECK RESULT CACHE
 # ============================================================================
-async def check_whatsapp_status(number: str) -> Tuple[bool, str]:
+# (check kind, number) -> (time stored, result), oldest first
+_check_cache: "OrderedDict[Tuple[str, str], Tuple[float, tuple]]" = OrderedDict()
+
+def _cache_get(kind: str, number: str) -> Optional[tuple]:
+    """Return a cached check result if it is still fresh"""
+    if not CHECK_CACHE_TTL:
+        return None
+    
+    entry = _check_cache.get((kind, number))
+    if entry is None:
+        return None
+    
+    if time.monotonic() - entry[0] >= CHECK_CACHE_TTL:
+        del _check_cache[(kind, number)]
+        return None
+    
+    return entry[1]
+
+def _cache_put(kind: str, number: str, result: tuple):
+    """Store a check result, evicting the oldest entry when full"""
+    if not CHECK_CACHE_TTL:
+        return
+    
+    key = (kind, number)
+    _check_cache[key] = (time.monotonic(), result)
+    _check_cache.move_to_end(key)
+    
+    if len(_check_cache) > CHECK_CACHE_SIZE:
+        _check_cache.popitem(last=False)
+
+# ============================================================================
+# CHECK FUNCTIONS
+# ============================================================================
+# Shared across all users so the backend never sees more than CHECK_CONCURRENCY calls.
+# Only held around the backend call itself: cache hits and checks waiting on
+# a rate limiter must not occupy a slot other users' checks could run in
+_check_semaphore = asyncio.Semaphore(CHECK_CONCURRENCY)
+
+# (check kind, number) -> running check task
+_in_flight: Dict[Tuple[str, str], asyncio.Task] = {}
+
+def _shared_check(kind: str, number: str, check) -> asyncio.Future:
     """
-    Simulate WhatsApp check
-    In production, replace with actual WhatsApp API
+    Start check(number), or join the identical one already running, so
+    overlapping jobs never pay twice for the same number
     """
-    await asyncio.sleep(0.05)  # Simulate API delay
+    key = (kind, number)
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.create_task(check(number))
+        _in_flight[key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
     
-    # Simulation logic (replace with real API)
+    # Shielded so one cancelled job doesn't cancel the check for the others
+    return asyncio.shield(task)
+
+# Paces WhatsApp calls under the provider's cap instead of reacting to 429s
+_whatsapp_limiter = AsyncLimiter(WHATSAPP_RATE_LIMIT, 60) if WHATSAPP_RATE_LIMIT else None
+
+if not SIMULATE:
+    import aiohttp
+
+# Shared keep-alive HTTP session for the check APIs (opened in post_init)
+http_session = None
+
+async def _api_get(url: str, number: str, limiter: Optional[AsyncLimiter] = None) -> dict:
+    """
+    GET url?number=<number> and return the JSON body, retrying 429/5xx
+    answers with exponential backoff (or the server's Retry-After)
+    Every attempt waits for limiter budget and then takes a concurrency
+    slot, which is released again while backing off
+    """
+    for attempt in range(API_MAX_ATTEMPTS):
+        if limiter:
+            await limiter.acquire()
+        
+        async with _check_semaphore:
+            async with http_session.get(url, params={'number': number}) as response:
+                retryable = response.status == 429 or response.status >= 500
+                retry_after = response.headers.get('Retry-After', '')
+                delay = int(retry_after) if retry_after.isdigit() else 2 ** attempt + random.random()
+                if not retryable or attempt == API_MAX_ATTEMPTS - 1 or delay > API_MAX_RETRY_DELAY:
+                    response.raise_for_status()
+                    return await response.json(loads=orjson.loads)
+        
+        logger.warning(f"{url} answered {response.status} for {number}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+# Private RNG for simulated wait times, independent of the global random state
+_sim_rng = random.Random()
+
+def _simulate_whatsapp(number: str) -> Tuple[bool, str]:
+    """Fake WhatsApp result derived from the last digit"""
     last_digit = int(number[-1]) if number[-1].isdigit() else 0
     
     if last_digit % 3 == 0:
@@ -199,140 +366,200 @@ async def check_whatsapp_status(number: str) -> Tuple[bool, str]:
     else:
         return False, "Not on WhatsApp"
 
-async def check_sms_status(number: str) -> Tuple[bool, str, Optional[str]]:
-    """
-    Simulate SMS receive check
-    In production, replace with actual SMS API
-    """
-    await asyncio.sleep(0.05)  # Simulate API delay
-    
-    # Simulation logic (replace with real API)
+def _simulate_sms(number: str) -> Tuple[bool, str, Optional[str]]:
+    """Fake SMS result derived from the last digit"""
     last_digit = int(number[-1]) if number[-1].isdigit() else 0
     
     if last_digit % 4 == 0:
         return True, "Can receive SMS", None
     elif last_digit % 4 == 1:
-        wait_time = random.randint(1, 15)
+        wait_time = _sim_rng.randint(1, 15)
         return False, f"Try again in {wait_time} min", f"{wait_time}:00"
     elif last_digit % 4 == 2:
-        wait_time = random.randint(16, 30)
+        wait_time = _sim_rng.randint(16, 30)
         return False, f"Try again in {wait_time} min", f"{wait_time}:00"
     else:
         return False, "Cannot receive SMS", None
 
+async def check_whatsapp_status(number: str) -> Tuple[bool, str]:
+    """
+    Check WhatsApp status
+    The API is expected to answer {"status": bool, "message": str}
+    """
+    cached = _cache_get('whatsapp', number)
+    if cached is not None:
+        return cached
+    
+    if SIMULATE:
+        # Wait for rate-limit budget before taking a concurrency slot
+        if _whatsapp_limiter:
+            await _whatsapp_limiter.acquire()
+        
+        async with _check_semaphore:
+            await asyncio.sleep(0.05)  # Simulate API delay
+            result = _simulate_whatsapp(number)
+    else:
+        data = await _api_get(WHATSAPP_API_URL, number, _whatsapp_limiter)
+        result = bool(data['status']), data['message']
+    
+    _cache_put('whatsapp', number, result)
+    return result
+
+async def check_sms_status(number: str) -> Tuple[bool, str, Optional[str]]:
+    """
+    Check SMS receive status
+    The API is expected to answer {"status": bool, "message": str, "wait_time": str | null}
+    """
+    cached = _cache_get('sms', number)
+    if cached is not None:
+        return cached
+    
+    if SIMULATE:
+        async with _check_semaphore:
+            await asyncio.sleep(0.05)  # Simulate API delay
+            result = _simulate_sms(number)
+    else:
+        data = await _api_get(SMS_API_URL, number)
+        result = bool(data['status']), data['message'], data.get('wait_time')
+    
+    _cache_put('sms', number, result)
+    return result
+
 async def process_numbers(
     numbers: List[str],
-    user_data: UserData
+    user_data: UserData,
+    progress: Optional[Callable[[int, int], Awaitable[None]]] = None
 ) -> Tuple[Dict[str, List], Dict[str, int]]:
     """
     Process numbers based on user's operation settings
+    progress(done, total) is awaited every PROGRESS_EDIT_INTERVAL seconds
+    while checks are running
     """
+    # Each distinct number is checked once, whatever the caller passes in
+    numbers = list(dict.fromkeys(numbers))
+    
+    # Read the settings once; they are constant for the whole run
+    operations = user_data.operations
+    whatsapp_enabled = operations['whatsapp']
+    whatsapp_type = operations['whatsapp_type']
+    sms_enabled = operations['sms']
+    sms_type = operations['sms_type']
+    combo_mode = operations['combo_mode']
+    
+    # Dispatch every check up front; the semaphore bounds how many run at once
+    whatsapp_checks = [
+        _shared_check('whatsapp', number, check_whatsapp_status) for number in numbers
+    ] if whatsapp_enabled else []
+    sms_checks = [
+        _shared_check('sms', number, check_sms_status) for number in numbers
+    ] if sms_enabled else []
+    # A failing check must not discard the others' completed work
+    all_checks = asyncio.gather(*whatsapp_checks, *sms_checks, return_exceptions=True)
+    
+    if progress:
+        # A number counts as checked once all of its checks have finished
+        checks_per_number = int(whatsapp_enabled) + int(sms_enabled)
+        pending = [checks_per_number] * len(numbers)
+        finished = 0
+        
+        def count_finished(index):
+            def callback(_):
+                nonlocal finished
+                pending[index] -= 1
+                if not pending[index]:
+                    finished += 1
+            return callback
+        
+        for i, check in enumerate(whatsapp_checks + sms_checks):
+            check.add_done_callback(count_finished(i % len(numbers)))
+        
+        while not all_checks.done():
+            await asyncio.wait({all_checks}, timeout=PROGRESS_EDIT_INTERVAL)
+            if not all_checks.done():
+                await progress(finished, len(numbers))
+    
+    check_results = await all_checks
+    total = len(numbers)
+    
+    # Numbers with any failed check are reported as errors, not classified
+    failed = {}
+    for i, result in enumerate(check_results):
+        if isinstance(result, BaseException):
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+            failed.setdefault(numbers[i % total], result)
+    
+    if failed:
+        logger.warning(f"{len(failed)} of {total} numbers failed to check, e.g. {next(iter(failed.values()))!r}")
+        check_results = [
+            result for i, result in enumerate(check_results) if numbers[i % total] not in failed
+        ]
+        numbers = [number for number in numbers if number not in failed]
+    
+    # (status, message) / (status, message, wait_time) tuples, None when not checked
+    whatsapp_count = len(numbers) if whatsapp_enabled else 0
+    whatsapp_results = check_results[:whatsapp_count] or [None] * len(numbers)
+    sms_results = check_results[whatsapp_count:] or [None] * len(numbers)
+    
     results = {
         'whatsapp_on': [],
         'whatsapp_off': [],
         'sms_on': [],
         'sms_off': [],
         'combo': [],
-        'processed': []
-    }
-    
-    stats = {
-        'total': len(numbers),
-        'whatsapp_on': 0,
-        'whatsapp_off': 0,
-        'sms_on': 0,
-        'sms_off': 0,
-        'combo': 0
+        'errors': list(failed)
     }
     
-    # Process in batches to avoid blocking
-    batch_size = 10
-    for i in range(0, len(numbers), batch_size):
-        batch = numbers[i:i + batch_size]
-        batch_tasks = []
-        
-        for number in batch:
-            # Create tasks based on selected operations
-            task_info = {'number': number}
-            
-            if user_data.operations['whatsapp']:
-                task_info['whatsapp_task'] = asyncio.create_task(check_whatsapp_status(number))
-            
-            if user_data.operations['sms']:
-                task_info['sms_task'] = asyncio.create_task(check_sms_status(number))
-            
-            batch_tasks.append(task_info)
+    # Materialize each category in one comprehension over the result columns
+    if combo_mode:
+        # A number must pass every enabled filter; ALL (or disabled) passes everything
+        whatsapp_any = not whatsapp_enabled or whatsapp_type == FilterType.ALL
+        whatsapp_want = whatsapp_type == FilterType.ON
+        sms_any = not sms_enabled or sms_type == FilterType.ALL
+        sms_want = sms_type == FilterType.ON
         
-        # Wait for all tasks in batch
-        for task_info in batch_tasks:
-            number = task_info['number']
-            whatsapp_result = None
-            sms_result = None
-            
-            if 'whatsapp_task' in task_info:
-                whatsapp_status, whatsapp_msg = await task_info['whatsapp_task']
-                whatsapp_result = {
-                    'status': whatsapp_status,
-                    'message': whatsapp_msg
-                }
-            
-            if 'sms_task' in task_info:
-                sms_status, sms_msg, sms_wait = await task_info['sms_task']
-                sms_result = {
-                    'status': sms_status,
-                    'message': sms_msg,
-                    'wait_time': sms_wait
-                }
-            
-            # Apply filters
-            whatsapp_match = True
-            sms_match = True
-            
-            if user_data.operations['whatsapp']:
-                if user_data.operations['whatsapp_type'] == 'on':
-                    whatsapp_match = whatsapp_result['status'] if whatsapp_result else False
-                elif user_data.operations['whatsapp_type'] == 'off':
-                    whatsapp_match = not whatsapp_result['status'] if whatsapp_result else False
-            
-            if user_data.operations['sms']:
-                if user_data.operations['sms_type'] == 'on':
-                    sms_match = sms_result['status'] if sms_result else False
-                elif user_data.operations['sms_type'] == 'off':
-                    sms_match = not sms_result['status'] if sms_result else False
-            
-            # Check combo condition
-            if user_data.operations['combo_mode']:
-                if whatsapp_match and sms_match:
-                    results['combo'].append(number)
-                    stats['combo'] += 1
-            else:
-                # Individual results
-                if whatsapp_match and user_data.operations['whatsapp']:
-                    if whatsapp_result and whatsapp_result['status']:
-                        results['whatsapp_on'].append(number)
-                        stats['whatsapp_on'] += 1
-                    else:
-                        results['whatsapp_off'].append(number)
-                        stats['whatsapp_off'] += 1
-                
-                if sms_match and user_data.operations['sms']:
-                    if sms_result and sms_result['status']:
-                        results['sms_on'].append(number)
-                        stats['sms_on'] += 1
-                    else:
-                        results['sms_off'].append(number)
-                        stats['sms_off'] += 1
-            
-            # Store processed result
-            results['processed'].append({
-                'number': number,
-                'whatsapp': whatsapp_result,
-                'sms': sms_result
-            })
+        # Pick the comprehension for this filter combination once, so the
+        # per-number test only looks at the columns that can reject it
+        if whatsapp_any and sms_any:
+            results['combo'] = list(numbers)
+        elif sms_any:
+            results['combo'] = [
+                n for n, r in zip(numbers, whatsapp_results) if r[0] == whatsapp_want
+            ]
+        elif whatsapp_any:
+            results['combo'] = [
+                n for n, r in zip(numbers, sms_results) if r[0] == sms_want
+            ]
+        else:
+            results['combo'] = [
+                number
+                for number, whatsapp_result, sms_result in zip(numbers, whatsapp_results, sms_results)
+                if whatsapp_result[0] == whatsapp_want and sms_result[0] == sms_want
+            ]
+    else:
+        # Individual results
+        if whatsapp_enabled:
+            if whatsapp_type != FilterType.OFF:
+                results['whatsapp_on'] = [n for n, r in zip(numbers, whatsapp_results) if r[0]]
+            if whatsapp_type != FilterType.ON:
+                results['whatsapp_off'] = [n for n, r in zip(numbers, whatsapp_results) if not r[0]]
         
-        # Small delay between batches
-        if i + batch_size < len(numbers):
-            await asyncio.sleep(0.1)
+        if sms_enabled:
+            if sms_type != FilterType.OFF:
+                results['sms_on'] = [n for n, r in zip(numbers, sms_results) if r[0]]
+            if sms_type != FilterType.ON:
+                results['sms_off'] = [n for n, r in zip(numbers, sms_results) if not r[0]]
+    
+    # Counts come straight from the category lists
+    stats = {
+        'total': total,
+        'whatsapp_on': len(results['whatsapp_on']),
+        'whatsapp_off': len(results['whatsapp_off']),
+        'sms_on': len(results['sms_on']),
+        'sms_off': len(results['sms_off']),
+        'combo': len(results['combo']),
+        'errors': len(results['errors'])
+    }
     
     return results, stats
 
@@ -340,58 +567,61 @@ def generate_result_file(results: Dict, user_data: UserData) -> BytesIO:
     """
     Generate result file based on operations
     """
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    now = datetime.now()
+    timestamp = now.strftime("%Y%m%d_%H%M%S")
+    time_line = f"Time: {now.strftime('%Y-%m-%d %H:%M:%S')} (UTC{TIMEZONE_OFFSET})\n"
+    
+    # Encode straight into the outgoing buffer, no full-size str/bytes copies
+    file_buffer = BytesIO()
+    out = TextIOWrapper(file_buffer, encoding='utf-8', newline='\n')
     
     if user_data.operations['combo_mode']:
         filename = f"combo_results_{timestamp}.txt"
-        content = "=== COMBO RESULTS ===\n"
-        content += f"Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} (UTC{TIMEZONE_OFFSET})\n"
-        content += f"Operations: {' AND '.join(user_data.get_operations_display())}\n\n"
+        out.write("=== COMBO RESULTS ===\n")
+        out.write(time_line)
+        out.write(f"Operations: {' AND '.join(user_data.get_operations_display())}\n\n")
         
         if results['combo']:
-            content += "Numbers matching ALL conditions:\n"
-            for number in results['combo']:
-                content += f"+{number}\n"
+            out.write("Numbers matching ALL conditions:\n")
+            out.writelines(f"+{number}\n" for number in results['combo'])
         else:
-            content += "No numbers matched all conditions\n"
+            out.write("No numbers matched all conditions\n")
     
     else:
         filename = f"checking_results_{timestamp}.txt"
-        content = "=== CHECKING RESULTS ===\n"
-        content += f"Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} (UTC{TIMEZONE_OFFSET})\n\n"
-        
-        ops_display = user_data.get_operations_display()
-        for op in ops_display:
-            content += f"{op}\n"
-        content += "\n"
+        out.write("=== CHECKING RESULTS ===\n")
+        out.write(time_line + "\n")
+        out.writelines(f"{op}\n" for op in user_data.get_operations_display())
+        out.write("\n")
         
         if user_data.operations['whatsapp']:
             if results['whatsapp_on']:
-                content += "✅ ON WHATSAPP:\n"
-                for number in results['whatsapp_on']:
-                    content += f"+{number}\n"
-                content += "\n"
+                out.write("✅ ON WHATSAPP:\n")
+                out.writelines(f"+{number}\n" for number in results['whatsapp_on'])
+                out.write("\n")
             
             if results['whatsapp_off']:
-                content += "❌ NOT ON WHATSAPP:\n"
-                for number in results['whatsapp_off']:
-                    content += f"+{number}\n"
-                content += "\n"
+                out.write("❌ NOT ON WHATSAPP:\n")
+                out.writelines(f"+{number}\n" for number in results['whatsapp_off'])
+                out.write("\n")
         
         if user_data.operations['sms']:
             if results['sms_on']:
-                content += "📨 CAN RECEIVE SMS:\n"
-                for number in results['sms_on']:
-                    content += f"+{number}\n"
-                content += "\n"
+                out.write("📨 CAN RECEIVE SMS:\n")
+                out.writelines(f"+{number}\n" for number in results['sms_on'])
+                out.write("\n")
             
             if results['sms_off']:
-                content += "⏳ SMS TRY AGAIN LATER:\n"
-                for number in results['sms_off']:
-                    content += f"+{number}\n"
+                out.write("⏳ SMS TRY AGAIN LATER:\n")
+                out.writelines(f"+{number}\n" for number in results['sms_off'])
     
-    # Convert to bytes
-    file_buffer = BytesIO(content.encode('utf-8'))
+    if results['errors']:
+        out.write("\n⚠️ CHECK FAILED (try again later):\n")
+        out.writelines(f"+{number}\n" for number in results['errors'])
+    
+    # Flush pending text and let go of the buffer without closing it
+    out.detach()
+    file_buffer.seek(0)
     file_buffer.name = filename
     
     return file_buffer
@@ -399,11 +629,32 @@ def generate_result_file(results: Dict, user_data: UserData) -> BytesIO:
 # ============================================================================
 # TELEGRAM BOT HANDLERS
 # ============================================================================
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /start command"""
-    user = update.effective_user
-    welcome_message = f"""
-👋 Welcome {user.first_name} to Number Validator Bot!
+# Manual operation setting such as "1,3" or "2,4,c" (commas alone don't count)
+_OP_RE = re.compile(r'^,*[1-4c\s][1-4c\s,]*$')
+
+# /setop keyboard is static, so build it once and reuse it
+_SETOP_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("1️⃣ WhatsApp On", callback_data="op_1"),
+        InlineKeyboardButton("2️⃣ WhatsApp Off", callback_data="op_2")
+    ],
+    [
+        InlineKeyboardButton("3️⃣ SMS On", callback_data="op_3"),
+        InlineKeyboardButton("4️⃣ SMS Off", callback_data="op_4")
+    ],
+    [
+        InlineKeyboardButton("🔀 Enable Combo", callback_data="op_combo"),
+        InlineKeyboardButton("✅ Apply Settings", callback_data="op_apply")
+    ],
+    [
+        InlineKeyboardButton("🔄 Reset to Default", callback_data="op_reset")
+    ]
+])
+
+# Command replies are built once at import; only the per-user fields are
+# filled in when a command arrives.
+_WELCOME_TEMPLATE = f"""
+👋 Welcome {{first_name}} to Number Validator Bot!
 
 I can check phone numbers for:
 ✅ WhatsApp status (On/Off WhatsApp)
@@ -426,12 +677,8 @@ I can check phone numbers for:
 
 ⏰ Timezone: UTC{TIMEZONE_OFFSET}
 """
-    
-    await update.message.reply_text(welcome_message)
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /help command"""
-    help_text = """
+_HELP_TEXT = f"""
 📚 **HELP GUIDE**
 
 **1. Sending Numbers:**
@@ -463,71 +710,15 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 - Maximum 1000 numbers per batch
 - Results are not stored
 """
-    await update.message.reply_text(help_text)
 
-async def setop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /setop command to set operations"""
-    user_id = update.effective_user.id
-    user_data = get_user_data(user_id)
-    
-    keyboard = [
-        [
-            InlineKeyboardButton("1️⃣ WhatsApp On", callback_data="op_1"),
-            InlineKeyboardButton("2️⃣ WhatsApp Off", callback_data="op_2")
-        ],
-        [
-            InlineKeyboardButton("3️⃣ SMS On", callback_data="op_3"),
-            InlineKeyboardButton("4️⃣ SMS Off", callback_data="op_4")
-        ],
-        [
-            InlineKeyboardButton("🔀 Enable Combo", callback_data="op_combo"),
-            InlineKeyboardButton("✅ Apply Settings", callback_data="op_apply")
-        ],
-        [
-            InlineKeyboardButton("🔄 Reset to Default", callback_data="op_reset")
-        ]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    ops_display = "\n".join([f"• {op}" for op in user_data.get_operations_display()])
-    
-    message = f"""
-⚙️ **SET OPERATIONS**
-
-Current settings:
-{ops_display}
-
-**Select operations:**
-1️⃣ - On WhatsApp only
-2️⃣ - Not on WhatsApp only
-3️⃣ - Can receive SMS only
-4️⃣ - SMS try again later
-
-**Combo Mode:** {'✅ Enabled' if user_data.operations['combo_mode'] else '❌ Disabled'}
-• Combo requires 2+ operations
-• Numbers must match ALL conditions
-
-**Or type manually:** "1,3" or "2,4,c"
-"""
-    
-    await update.message.reply_text(message, reply_markup=reply_markup)
-
-async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /status command"""
-    user_id = update.effective_user.id
-    user_data = get_user_data(user_id)
-    
-    ops_display = "\n".join([f"• {op}" for op in user_data.get_operations_display()])
-    
-    status_message = f"""
+_STATUS_TEMPLATE = f"""
 📊 **BOT STATUS**
 
 **Your Settings:**
-{ops_display}
+{{ops_display}}
 
 **Timezone:** UTC{TIMEZONE_OFFSET}
-**Last Activity:** {user_data.last_activity.strftime('%Y-%m-%d %H:%M:%S')}
+**Last Activity:** {{last_activity}}
 
 **Ready to receive:**
 • List of numbers (paste)
@@ -536,12 +727,8 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 Use /setop to change operations
 """
-    
-    await update.message.reply_text(status_message)
 
-async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /about command"""
-    about_text = """
+_ABOUT_TEXT = f"""
 🤖 **Number Validator Bot**
 
 **Version:** 2.0.0
@@ -566,7 +753,102 @@ Format: +[country code][number]
 
 **For support:** Contact developer
 """
-    await update.message.reply_text(about_text)
+
+def progress_editor(message: Message) -> Callable[[int, int], Awaitable[None]]:
+    """Build a process_numbers progress callback that edits message"""
+    header = message.text
+    last_done = 0
+    
+    async def report(done: int, total: int):
+        nonlocal last_done
+        # Telegram rejects edits that don't change the text
+        if done == last_done:
+            return
+        
+        last_done = done
+        try:
+            await message.edit_text(f"{header}\n✔️ Checked {done}/{total}")
+        except TelegramError as e:
+            logger.warning(f"Could not update progress: {e}")
+    
+    return report
+
+async def send_results(process_msg: Message, stats_text: str, reply: Awaitable[Message]):
+    """
+    Edit process_msg to stats_text while reply (the results upload) runs
+    A failed edit is only logged; a failed upload is raised to the caller
+    """
+    edited, sent = await asyncio.gather(
+        process_msg.edit_text(stats_text), reply, return_exceptions=True
+    )
+    if isinstance(edited, Exception):
+        logger.warning(f"Could not update processing message: {edited}")
+    if isinstance(sent, BaseException):
+        raise sent
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /start command"""
+    user = update.effective_user
+    await update.message.reply_text(
+        _WELCOME_TEMPLATE.format(first_name=user.first_name)
+    )
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /help command"""
+    await update.message.reply_text(_HELP_TEXT)
+
+async def setop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /setop command to set operations"""
+    user_id = update.effective_user.id
+    user_data = await get_user_data(user_id)
+    
+    ops_display = "\n".join([f"• {op}" for op in user_data.get_operations_display()])
+    
+    message = f"""
+⚙️ **SET OPERATIONS**
+
+Current settings:
+{ops_display}
+
+**Select operations:**
+1️⃣ - On WhatsApp only
+2️⃣ - Not on WhatsApp only
+3️⃣ - Can receive SMS only
+4️⃣ - SMS try again later
+
+**Combo Mode:** {'✅ Enabled' if user_data.operations['combo_mode'] else '❌ Disabled'}
+• Combo requires 2+ operations
+• Numbers must match ALL conditions
+
+**Or type manually:** "1,3" or "2,4,c"
+"""
+    
+    await update.message.reply_text(message, reply_markup=_SETOP_KEYBOARD)
+
+async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /status command"""
+    user_id = update.effective_user.id
+    user_data = await get_user_data(user_id)
+    
+    ops_display = "\n".join([f"• {op}" for op in user_data.get_operations_display()])
+    
+    await update.message.reply_text(_STATUS_TEMPLATE.format(
+        ops_display=ops_display,
+        last_activity=user_data.last_activity.strftime('%Y-%m-%d %H:%M:%S'),
+    ))
+
+async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /about command"""
+    await update.message.reply_text(_ABOUT_TEXT)
+
+async def flushcache_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /flushcache command (admins only)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    cleared = len(_check_cache)
+    _check_cache.clear()
+    await update.message.reply_text(f"🧹 Cleared {cleared} cached check results")
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button callbacks"""
@@ -574,32 +856,32 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     user_id = update.effective_user.id
-    user_data = get_user_data(user_data)
+    user_data = await get_user_data(user_id)
     
     data = query.data
     
     if data == "op_1":
         user_data.operations['whatsapp'] = True
-        user_data.operations['whatsapp_type'] = 'on'
+        user_data.operations['whatsapp_type'] = FilterType.ON
         user_data.operations['sms'] = False
         await query.edit_message_text("✅ Set: On WhatsApp only\nClick 'Apply Settings' when done")
     
     elif data == "op_2":
         user_data.operations['whatsapp'] = True
-        user_data.operations['whatsapp_type'] = 'off'
+        user_data.operations['whatsapp_type'] = FilterType.OFF
         user_data.operations['sms'] = False
         await query.edit_message_text("✅ Set: Not on WhatsApp only\nClick 'Apply Settings' when done")
     
     elif data == "op_3":
         user_data.operations['whatsapp'] = False
         user_data.operations['sms'] = True
-        user_data.operations['sms_type'] = 'on'
+        user_data.operations['sms_type'] = FilterType.ON
         await query.edit_message_text("✅ Set: Can receive SMS only\nClick 'Apply Settings' when done")
     
     elif data == "op_4":
         user_data.operations['whatsapp'] = False
         user_data.operations['sms'] = True
-        user_data.operations['sms_type'] = 'off'
+        user_data.operations['sms_type'] = FilterType.OFF
         await query.edit_message_text("✅ Set: SMS try again later\nClick 'Apply Settings' when done")
     
     elif data == "op_combo":
@@ -624,15 +906,17 @@ Send list or file now.
             'whatsapp': True,
             'sms': True,
             'combo_mode': False,
-            'whatsapp_type': 'all',
-            'sms_type': 'all'
+            'whatsapp_type': FilterType.ALL,
+            'sms_type': FilterType.ALL
         }
         await query.edit_message_text("🔄 Reset to default settings\nBoth WhatsApp and SMS checking enabled")
+    
+    await save_user_data(user_id, user_data)
 
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text messages containing numbers"""
     user_id = update.effective_user.id
-    user_data = get_user_data(user_id)
+    user_data = await get_user_data(user_id)
     
     if user_data.processing:
         await update.message.reply_text("⏳ Please wait, still processing previous request...")
@@ -640,9 +924,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     # Check if this is a manual operation setting
     text = update.message.text.strip()
-    if re.match(r'^[1-4,c\s]+$', text.replace(',', '')):
+    if _OP_RE.match(text):
         # It's an operation setting
-        await handle_manual_operation(update, text)
+        await handle_manual_operation(update, text, user_data)
         return
     
     user_data.processing = True
@@ -673,20 +957,24 @@ Format examples:
             await update.message.reply_text("⚠️ Too many numbers! Maximum is 1000. Sending first 1000...")
             numbers = numbers[:1000]
         
+        # A job runs with the settings it started with, even if /setop
+        # changes them while it is in progress
+        job_settings = user_data.snapshot()
+        
         # Send processing message
-        ops_display = " + ".join(user_data.get_operations_display())
+        ops_display = " + ".join(job_settings.get_operations_display())
         process_msg = await update.message.reply_text(
             f"📊 Processing {len(numbers)} numbers...\n"
             f"🔍 Checking: {ops_display}\n"
-            f"⏳ Estimated time: {len(numbers) * 0.2:.0f} seconds...\n"
+            f"⏳ Processing... This may take a moment\n"
             f"🕐 Timezone: UTC{TIMEZONE_OFFSET}"
         )
         
         # Process numbers
-        results, stats = await process_numbers(numbers, user_data)
+        results, stats = await process_numbers(numbers, job_settings, progress_editor(process_msg))
         
         # Generate and send file
-        file_buffer = generate_result_file(results, user_data)
+        file_buffer = generate_result_file(results, job_settings)
         
         # Update processing message
         stats_text = f"""
@@ -699,17 +987,16 @@ Format examples:
 • SMS Can Receive: {stats['sms_on']}
 • SMS Try Later: {stats['sms_off']}
 • Combo Matches: {stats['combo']}
+• Check Errors: {stats['errors']}
 
 📁 Sending results file...
 """
         
-        await process_msg.edit_text(stats_text)
-        
-        # Send file
-        await update.message.reply_document(
+        # Update processing message and send the file concurrently
+        await send_results(process_msg, stats_text, update.message.reply_document(
             document=file_buffer,
             caption=f"Results - UTC{TIMEZONE_OFFSET}"
-        )
+        ))
         
     except Exception as e:
         logger.error(f"Error processing text: {e}")
@@ -718,10 +1005,9 @@ Format examples:
     finally:
         user_data.processing = False
 
-async def handle_manual_operation(update: Update, text: str):
+async def handle_manual_operation(update: Update, text: str, user_data: UserData):
     """Handle manual operation setting via text"""
     user_id = update.effective_user.id
-    user_data = get_user_data(user_id)
     
     parts = [p.strip() for p in text.split(',')]
     
@@ -729,26 +1015,28 @@ async def handle_manual_operation(update: Update, text: str):
     user_data.operations['whatsapp'] = False
     user_data.operations['sms'] = False
     user_data.operations['combo_mode'] = False
-    user_data.operations['whatsapp_type'] = 'all'
-    user_data.operations['sms_type'] = 'all'
+    user_data.operations['whatsapp_type'] = FilterType.ALL
+    user_data.operations['sms_type'] = FilterType.ALL
     
     # Parse operations
     for part in parts:
         if part == '1':
             user_data.operations['whatsapp'] = True
-            user_data.operations['whatsapp_type'] = 'on'
+            user_data.operations['whatsapp_type'] = FilterType.ON
         elif part == '2':
             user_data.operations['whatsapp'] = True
-            user_data.operations['whatsapp_type'] = 'off'
+            user_data.operations['whatsapp_type'] = FilterType.OFF
         elif part == '3':
             user_data.operations['sms'] = True
-            user_data.operations['sms_type'] = 'on'
+            user_data.operations['sms_type'] = FilterType.ON
         elif part == '4':
             user_data.operations['sms'] = True
-            user_data.operations['sms_type'] = 'off'
+            user_data.operations['sms_type'] = FilterType.OFF
         elif part.lower() == 'c':
             user_data.operations['combo_mode'] = True
     
+    await save_user_data(user_id, user_data)
+    
     ops_display = "\n".join(user_data.get_operations_display())
     
     await update.message.reply_text(f"""
@@ -764,7 +1052,7 @@ Format: +2348123456789 or upload file
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle document uploads"""
     user_id = update.effective_user.id
-    user_data = get_user_data(user_id)
+    user_data = await get_user_data(user_id)
     
     if user_data.processing:
         await update.message.reply_text("⏳ Please wait, still processing previous request...")
@@ -775,19 +1063,20 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         document = update.message.document
-        file = await document.get_file()
-        file_content = await file.download_as_bytearray()
         
-        # Check file type
-        filename = document.file_name.lower()
+        # Check file type before downloading anything
+        filename = (document.file_name or '').lower()
         
         if not (filename.endswith('.txt') or filename.endswith('.csv')):
             await update.message.reply_text("❌ Unsupported file type! Please send .txt or .csv files only.")
             user_data.processing = False
             return
         
-        # Extract numbers
-        numbers = extract_numbers_from_file(file_content, filename)
+        file = await document.get_file()
+        file_content = await file.download_as_bytearray()
+        
+        # Extract numbers (in a worker thread so large files don't stall other updates)
+        numbers = await asyncio.to_thread(extract_numbers_from_file, file_content, filename)
         
         if not numbers:
             await update.message.reply_text("❌ No valid phone numbers found in the file!")
@@ -798,8 +1087,12 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("⚠️ Large file detected! Processing first 1000 numbers...")
             numbers = numbers[:1000]
         
+        # A job runs with the settings it started with, even if /setop
+        # changes them while it is in progress
+        job_settings = user_data.snapshot()
+        
         # Send processing message
-        ops_display = " + ".join(user_data.get_operations_display())
+        ops_display = " + ".join(job_settings.get_operations_display())
         process_msg = await update.message.reply_text(
             f"📄 File received: {document.file_name}\n"
             f"📊 Found {len(numbers)} numbers\n"
@@ -809,10 +1102,10 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
         # Process numbers
-        results, stats = await process_numbers(numbers, user_data)
+        results, stats = await process_numbers(numbers, job_settings, progress_editor(process_msg))
         
         # Generate and send file
-        file_buffer = generate_result_file(results, user_data)
+        file_buffer = generate_result_file(results, job_settings)
         
         # Update processing message
         stats_text = f"""
@@ -825,17 +1118,16 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • SMS Can Receive: {stats['sms_on']}
 • SMS Try Later: {stats['sms_off']}
 • Combo Matches: {stats['combo']}
+• Check Errors: {stats['errors']}
 
 📁 Sending results file...
 """
         
-        await process_msg.edit_text(stats_text)
-        
-        # Send file
-        await update.message.reply_document(
+        # Update processing message and send the file concurrently
+        await send_results(process_msg, stats_text, update.message.reply_document(
             document=file_buffer,
             caption=f"Results from {document.file_name} - UTC{TIMEZONE_OFFSET}"
-        )
+        ))
         
     except Exception as e:
         logger.error(f"Error processing document: {e}")
@@ -859,10 +1151,51 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ============================================================================
 # APPLICATION SETUP
 # ============================================================================
+async def post_init(application: Application):
+    """Open shared connections"""
+    global http_session
+    if not SIMULATE:
+        if not (WHATSAPP_API_URL and SMS_API_URL):
+            raise RuntimeError("WHATSAPP_API_URL and SMS_API_URL must be set when SIMULATE=false")
+        
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=CHECK_CONCURRENCY,
+                limit_per_host=API_CONNECTIONS_PER_HOST,
+                keepalive_timeout=30
+            ),
+            timeout=aiohttp.ClientTimeout(total=API_TIMEOUT)
+        )
+
+async def post_shutdown(application: Application):
+    """Release shared connections"""
+    if http_session:
+        await http_session.close()
+    if redis_client:
+        await redis_client.aclose()
+
 def main():
     """Start the bot"""
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL (or RENDER_EXTERNAL_URL) must be set when BOT_MODE=webhook")
+    
+    # uvloop is a faster drop-in event loop (not available on Windows)
+    if sys.platform != 'win32':
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            logger.info("Using uvloop event loop")
+        except ImportError:
+            logger.info("uvloop not installed, using default asyncio event loop")
+    
     # Create Application
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Add command handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -870,25 +1203,28 @@ def main():
     application.add_handler(CommandHandler("setop", setop_command))
     application.add_handler(CommandHandler("status", status_command))
     application.add_handler(CommandHandler("about", about_command))
+    application.add_handler(CommandHandler("flushcache", flushcache_command))
     
     # Add callback query handler for buttons
     application.add_handler(CallbackQueryHandler(button_callback))
     
-    # Add message handlers
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
-    application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    # Add message handlers (non-blocking: checks run as application tasks so
+    # long jobs don't hold up other users' updates)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message, block=False))
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_document, block=False))
     
     # Add error handler
     application.add_error_handler(error_handler)
     
     # Start the bot
-    if "RENDER" in os.environ:
-        # Running on Render
+    if BOT_MODE == "webhook":
+        # Telegram pushes updates to us (Render / production)
         application.run_webhook(
-            listen="0.0.0.0",
+            listen=WEBHOOK_LISTEN,
             port=PORT,
-            url_path=TOKEN,
-            webhook_url=f"https://your-app-name.onrender.com/{TOKEN}"
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            allowed_updates=Update.ALL_TYPES
         )
     else:
         # Running locally